@@ -1,13 +1,125 @@
-import geopandas as gpd
+import numpy as np
+import operator
+import shapely
 
-from fiona.drvsupport import supported_drivers
-from shapely.geometry import LineString, shape
+from shapely.geometry import LineString
 from pyproj import Geod
-from math import acos, degrees
+from numba import njit
+from math import cos, radians
+from xml.etree import ElementTree
 
 
-supported_drivers["KML"] = "rw"
-supported_drivers["LIBKML"] = "rw"
+# WGS84 mean earth radius in meters
+EARTH_RADIUS = 6371008.8
+
+# shared by all routes, a Geod holds no state once constructed
+GEOD = Geod(ellps="WGS84")
+
+
+@njit(cache=True, fastmath=True)
+def _get_haversine_distance(lon1, lat1, cos_lat1, lon2, lat2, cos_lat2):
+    """
+    Calculates the great circle distance in meters between coordinates given
+    in radians, along with the cosine of their latitudes. Works on floats as
+    well as on arrays of coordinates.
+    """
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + cos_lat1 * cos_lat2 * np.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+@njit(cache=True, fastmath=True)
+def _get_coord_cosine(A: float, B: float, C: float) -> float:
+    """
+    Calculates the cosine of the angle between three lines A, B, C. The
+    angle is the angle between the line A-B and the line B-C. Degenerate
+    lines are treated as an angle of 0.
+    """
+    if A == 0 or C == 0:
+        return 1.0
+    cos_angle = (A * A + C * C - B * B) / (2 * A * C)
+    return min(1.0, max(-1.0, cos_angle))
+
+
+# a single float64 signature so that any cutoffs share one compiled and
+# cached kernel
+@njit("b1[:](f8[:, :], f8, f8)", cache=True)
+def _smooth_kernel(
+    coords: np.ndarray, cutoff_distance: float, cutoff_angle: float
+) -> np.ndarray:
+    """
+    Returns a mask of the coordinates kept after smoothening by distance and
+    then by angle, in a single walk over the coordinates. A coordinate is
+    only checked against the angle once the next coordinate kept by the
+    distance check is known. An infinite cutoff distance or a zero cutoff
+    angle disables the respective check.
+    """
+    # cosine decreases on [0, 180], so the angle is below the cutoff
+    # exactly when its cosine is above the cosine of the cutoff
+    cos_cutoff = cos(radians(cutoff_angle))
+
+    n = len(coords)
+    keep = np.zeros(n, dtype=np.bool_)
+    keep[0] = True
+    keep[n - 1] = True
+
+    lons = np.radians(coords[:, 0])
+    lats = np.radians(coords[:, 1])
+    cos_lats = np.cos(lats)
+    segment_distances = _get_haversine_distance(
+        lons[:-1], lats[:-1], cos_lats[:-1], lons[1:], lats[1:], cos_lats[1:]
+    )
+
+    last_kept_by_distance = 0
+    last_kept = 0
+    pending = -1
+    # distance between the last kept and the pending coordinate
+    pending_distance = 0.0
+    for i in range(1, n):
+        if last_kept_by_distance == i - 1:
+            current_distance = segment_distances[i - 1]
+        else:
+            current_distance = _get_haversine_distance(
+                lons[last_kept_by_distance],
+                lats[last_kept_by_distance],
+                cos_lats[last_kept_by_distance],
+                lons[i],
+                lats[i],
+                cos_lats[i],
+            )
+        if i < n - 1 and current_distance >= cutoff_distance:
+            continue
+        last_kept_by_distance = i
+
+        if pending > 0:
+            # the pending coordinate is the previous one kept by distance,
+            # so the current distance is the pending to current line
+            last_kept_to_current_distance = _get_haversine_distance(
+                lons[last_kept],
+                lats[last_kept],
+                cos_lats[last_kept],
+                lons[i],
+                lats[i],
+                cos_lats[i],
+            )
+            coord_cosine = _get_coord_cosine(
+                pending_distance,
+                last_kept_to_current_distance,
+                current_distance,
+            )
+            if coord_cosine <= cos_cutoff:
+                keep[pending] = True
+                last_kept = pending
+                pending_distance = current_distance
+            else:
+                pending_distance = last_kept_to_current_distance
+        else:
+            pending_distance = current_distance
+        pending = i
+
+    return keep
 
 
 class Route:
@@ -41,11 +153,35 @@ class Route:
         """
 
         self.path = path
-        self.gdf: gpd.GeoDataFrame = gpd.read_file(path, driver="KML")
-        self.line_string: LineString = self.gdf.geometry.iloc[0]
+        self._coords: np.ndarray = self.__read_coords(path)
         self.__remove_close_duplicate_coords()
-        self.geod = Geod(ellps="WGS84")
-        self.smoothened_line_string = None
+        self.geod = GEOD
+        self._smoothened_coords: np.ndarray = None
+
+    @property
+    def line_string(self) -> LineString:
+        """The raw line string of the route"""
+        return LineString(self._coords)
+
+    @line_string.setter
+    def line_string(self, line_string: LineString) -> None:
+        self._coords = np.asarray(line_string.coords, dtype=np.float64)
+
+    @property
+    def smoothened_line_string(self) -> LineString:
+        """The smoothened line string of the route, if smoothened"""
+        if self._smoothened_coords is None:
+            return None
+        return LineString(self._smoothened_coords)
+
+    @smoothened_line_string.setter
+    def smoothened_line_string(self, line_string: LineString) -> None:
+        if line_string is None:
+            self._smoothened_coords = None
+        else:
+            self._smoothened_coords = np.asarray(
+                line_string.coords, dtype=np.float64
+            )
 
     def get_total_distance(self) -> str:
         """Returns the total distance of smoothen (if available) or raw route
@@ -56,107 +192,90 @@ class Route:
             The total distance of the route in kilometers
         """
 
-        line_string = self.__get_line_string()
-        return f"{self.geod.geometry_length(line_string)/1000:.3f}"
+        line_coords = self.__get_coords()
+        segment_distances = self.geod.line_lengths(
+            line_coords[:, 0], line_coords[:, 1]
+        )
+        return f"{np.sum(segment_distances)/1000:.3f}"
 
     def _smoothen_by_simplifying(self, granular_level: float) -> None:
         """Smoothen the line string by a given granular level"""
 
         tolerance = granular_level * 0.00003
-        self.smoothened_line_string = self.__get_line_string().simplify(
-            tolerance,
+        line_coords = self.__get_coords()
+        simplified_line_string = shapely.simplify(
+            shapely.linestrings(line_coords), tolerance
+        )
+        self._smoothened_coords = shapely.get_coordinates(
+            simplified_line_string, include_z=line_coords.shape[1] == 3
         )
 
     def _smoothen_by_distance(self, cutoff_distance: int):
         """Smoothen the line string by a given cutoff distance"""
 
-        line_coords = list(shape(self.__get_line_string()).coords)
-        filtered_coords = []
-
-        for i, line_coord in enumerate(line_coords):
-            if i == 0 or i == len(line_coords) - 1:
-                filtered_coords.append(line_coord)
-                continue
-
-            current_distance = self.__get_distance_between_coords(
-                filtered_coords[-1], line_coord
-            )
-
-            if current_distance < cutoff_distance:
-                filtered_coords.append(line_coord)
-
-        self.smoothened_line_string = LineString(filtered_coords)
+        line_coords = self.__get_coords()
+        keep = _smooth_kernel(line_coords, cutoff_distance, 0)
+        self._smoothened_coords = line_coords[keep]
 
     def _smoothen_by_angle(self, cutoff_angle: int) -> None:
         """Smoothen the line string by a given cutoff angle"""
 
-        line_coords = list(shape(self.__get_line_string()).coords)
-        filtered_coords = []
-
-        geod = self.geod
-        for i, line_coord in enumerate(line_coords):
-            if i == 0 or i == len(line_coords) - 1:
-                filtered_coords.append(line_coord)
-                continue
-
-            previous_to_current_distance = self.__get_distance_between_coords(
-                filtered_coords[-1], line_coord
-            )
-
-            current_to_next_distance = self.__get_distance_between_coords(
-                line_coord, line_coords[i + 1]
-            )
-
-            previous_to_next_distance = self.__get_distance_between_coords(
-                filtered_coords[-1], line_coords[i + 1]
-            )
-
-            if (
-                self.__get_coord_angle(
-                    previous_to_current_distance,
-                    previous_to_next_distance,
-                    current_to_next_distance,
-                )
-                < cutoff_angle
-            ):
-                continue
-            filtered_coords.append(line_coord)
-
-        self.smoothened_line_string = LineString(filtered_coords)
+        line_coords = self.__get_coords()
+        keep = _smooth_kernel(line_coords, np.inf, cutoff_angle)
+        self._smoothened_coords = line_coords[keep]
 
     @staticmethod
-    def __get_coord_angle(A: float, B: float, C: float) -> float:
+    def __get_coord_cosine(A: float, B: float, C: float) -> float:
         """
-        Calculates the angle between three lines A, B, C in degrees. The
-        returned angle is the angle between the line A-B and the line B-C.
+        Calculates the cosine of the angle between three lines A, B, C. The
+        angle is the angle between the line A-B and the line B-C.
         """
-        try:
-            return degrees(acos((A * A + C * C - B * B) / (2 * A * C)))
-        except (ValueError, ZeroDivisionError):
-            return 0
+        return _get_coord_cosine(A, B, C)
 
     def __get_line_string(self) -> LineString:
         """
         Returns the smoothen line string (if exists)  of raw line string
         of the route
         """
-        if self.smoothened_line_string:
-            return self.smoothened_line_string
-        return self.line_string
+        return LineString(self.__get_coords())
+
+    def __get_coords(self) -> np.ndarray:
+        """
+        Returns the coordinates of the smoothen (if exists) or raw line
+        string of the route as an (N, 3) array
+        """
+        if self._smoothened_coords is not None:
+            return self._smoothened_coords
+        return self._coords
+
+    @staticmethod
+    def __read_coords(path: str) -> np.ndarray:
+        """Reads the coordinates of the first line string of a kml file"""
+        try:
+            root = ElementTree.parse(path).getroot()
+        except (OSError, ElementTree.ParseError) as error:
+            raise ValueError(f"{path} is not a valid kml file") from error
+
+        coordinates = root.find(".//{*}LineString/{*}coordinates")
+        if coordinates is None or not coordinates.text:
+            raise ValueError(f"{path} does not contain a line string")
+
+        return np.array(
+            [coord.split(",") for coord in coordinates.text.split()],
+            dtype=np.float64,
+        )
 
     def __remove_close_duplicate_coords(self):
         """Remove similar coordinates that are too close to each other"""
-        line_coords = list(shape(self.line_string).coords)
+        line_coords = self._coords
 
-        filtered_coords = []
-        for i, line_coord in enumerate(line_coords):
-            if i == 0:
-                filtered_coords.append(line_coord)
-                continue
-            if line_coord != filtered_coords[-1]:
-                filtered_coords.append(line_coord)
+        # dropped coordinates equal the last kept one, so comparing with the
+        # previous coordinate is enough
+        keep = np.empty(len(line_coords), dtype=bool)
+        keep[0] = True
+        keep[1:] = np.any(line_coords[1:] != line_coords[:-1], axis=1)
 
-        self.line_string = LineString(filtered_coords)
+        self._coords = line_coords[keep]
 
     def to_file(self, path: str = None):
         """Write the smoothen route to a file
@@ -166,10 +285,20 @@ class Route:
         path : str, optional
             The path to the file. If not provided, the path of the original file
         """
+        from fiona.drvsupport import supported_drivers
+        from geopandas import GeoDataFrame
+
+        supported_drivers["KML"] = "rw"
+        supported_drivers["LIBKML"] = "rw"
+
         if not path:
             path = self.path
-        self.gdf.geometry.iloc[0] = self.__get_line_string()
-        self.gdf.to_file(path, driver="KML")
+        gdf = GeoDataFrame(
+            {"Name": ["route"]},
+            geometry=[self.__get_line_string()],
+            crs="EPSG:4326",
+        )
+        gdf.to_file(path, driver="KML")
 
     def smoothen_route(
         self,
@@ -200,9 +329,10 @@ class Route:
         self.__validate_smoothen_input(
             granular_level, cutoff_angle, cutoff_distance
         )
-        self.smoothened_line_string = None
-        self._smoothen_by_distance(cutoff_distance)
-        self._smoothen_by_angle(cutoff_angle)
+        self._smoothened_coords = None
+        line_coords = self.__get_coords()
+        keep = _smooth_kernel(line_coords, cutoff_distance, cutoff_angle)
+        self._smoothened_coords = line_coords[keep]
         self._smoothen_by_simplifying(granular_level)
 
     def __get_distance_between_coords(
@@ -211,30 +341,29 @@ class Route:
         """
         Calculates the distance between two coordinates in meters
         """
-        line_string = LineString([coord1, coord2])
-        return self.geod.geometry_length(line_string)
+        _, _, distance = self.geod.inv(
+            coord1[0], coord1[1], coord2[0], coord2[1]
+        )
+        return distance
 
     def __validate_smoothen_input(
         self, granular_level, cutoff_angle, cutoff_distance
     ) -> None:
         """Validate the input for smoothen_route"""
-        if not isinstance(granular_level, int):
-            raise ValueError("Granular level must be an integer")
-
-        if granular_level < 0 or granular_level > 10:
-            raise ValueError("Granular level must be between 0 and 10")
-
-        if not isinstance(cutoff_angle, int):
-            raise ValueError("Cutoff angle must be an integer")
-
-        if cutoff_angle < 0 or cutoff_angle > 60:
-            raise ValueError("Cutoff angle must be between 0 and 60")
-
-        if not isinstance(cutoff_distance, int):
-            raise ValueError("Cutoff distance must be an integer")
-
-        if cutoff_distance < 0 or cutoff_distance > 1000:
-            raise ValueError("Cutoff distance must be between 0 and 1000")
+        for name, value, lower, upper in (
+            ("Granular level", granular_level, 0, 10),
+            ("Cutoff angle", cutoff_angle, 0, 60),
+            ("Cutoff distance", cutoff_distance, 0, 1000),
+        ):
+            try:
+                value = operator.index(value)
+            except TypeError:
+                raise ValueError(f"{name} must be an integer") from None
+
+            if value < lower or value > upper:
+                raise ValueError(
+                    f"{name} must be between {lower} and {upper}"
+                )
 
 
 # route = Route("task_2_sensor.kml")
@@ -47,6 +47,9 @@ class TestRoute:
         sample_route.smoothen_route()
         sample_route.to_file(file)
         assert os.path.exists(file)
+        assert Route(file).line_string.equals(
+            sample_route.smoothened_line_string
+        )
 
     def test_invalid_file(self):
         """
@@ -130,18 +133,20 @@ class TestRoute:
         line_string_after_smoothing = sample_route._Route__get_line_string()
         assert line_string_before_smoothing != line_string_after_smoothing
 
-    def test_get_coord_angle(self, sample_route: Route):
+    def test_get_coord_cosine(self, sample_route: Route):
         """
-        Test that angle between three lines is returned
+        Test that the cosine of the angle between three lines is returned
         """
-        coord_angle = sample_route._Route__get_coord_angle(2, 2, 2)
-        assert coord_angle == pytest.approx(60, 0.1)
+        coord_cosine = sample_route._Route__get_coord_cosine(2, 2, 2)
+        assert coord_cosine == pytest.approx(0.5, 0.1)
 
     def test_remove_close_duplicate_coords(self, sample_route: Route):
         """
         Test that close duplicate coordinates are removed
         """
-        raw_line_string = sample_route.gdf.geometry.iloc[0]
+        raw_line_string = LineString(
+            sample_route._Route__read_coords(self.test_file)
+        )
         sample_route.line_string = raw_line_string
 
         coord_count_before_removal = len(sample_route.line_string.coords)